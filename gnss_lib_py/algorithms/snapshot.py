@@ -12,12 +12,19 @@ __date__ = "25 Jan 2022"
 import warnings
 
 import numpy as np
+from scipy.linalg import get_lapack_funcs, lstsq
 
 from gnss_lib_py.navdata.navdata import NavData
 from gnss_lib_py.utils import constants as consts
-from gnss_lib_py.navdata.operations import loop_time, find_wildcard_indexes
+from gnss_lib_py.navdata.operations import loop_time_indexes, \
+                                         find_wildcard_indexes
 from gnss_lib_py.utils.coordinates import ecef_to_geodetic
 
+# double precision Cholesky solve, looked up once instead of per call
+_DPOSV, = get_lapack_funcs(("posv",), dtype=np.float64)
+
+_MIN_SVS_ERROR = "Need at least four satellites for WLS."
+
 def solve_wls(measurements, weight_type = None, only_bias = False,
               receiver_state=None, tol = 1e-7, max_count = 20,
               sv_rx_time=False, delta_t_decimals=-2):
@@ -33,6 +40,10 @@ def solve_wls(measurements, weight_type = None, only_bias = False,
     If only_bias is set to True, then the receiver position must also
     be passed in as the receiver_state.
 
+    Each timestep is initialized with the previous valid estimate.
+    Until a valid estimate exists, the closed form Bancroft solution
+    is used as the initial guess.
+
     Parameters
     ----------
     measurements : gnss_lib_py.navdata.navdata.NavData
@@ -49,7 +60,9 @@ def solve_wls(measurements, weight_type = None, only_bias = False,
         NavData class with at least the following rows: ``x_rx*_m``,
         ``y_rx*_m``, ``z_rx*_m``, ``gps_millis``.
     tol : float
-        Tolerance used for the convergence check.
+        Tolerance used for the convergence check. Iterations stop once
+        every component of the state update, in meters, is within
+        the tolerance.
     max_count : int
         Number of maximum iterations before process is aborted and
         solution returned.
@@ -91,42 +104,68 @@ def solve_wls(measurements, weight_type = None, only_bias = False,
     states = []
     runtime_error_idxs = {}
 
-    position = np.zeros((4,1))
-    for timestamp, _, measurement_subset in loop_time(measurements,"gps_millis",
-                                                      delta_t_decimals=delta_t_decimals):
+    # extract measurement rows once instead of copying a NavData
+    # instance for every timestep
+    if len(measurements) > 0:
+        pos_sv_m_all = measurements[["x_sv_m","y_sv_m","z_sv_m"]].reshape(3,-1).T
+        corr_pr_m_all = np.atleast_1d(measurements["corr_pr_m"]).reshape(-1,1)
 
-        pos_sv_m = measurement_subset[["x_sv_m","y_sv_m","z_sv_m"]].T
-        pos_sv_m = np.atleast_2d(pos_sv_m)
+        # remove NaN indexes
+        not_nan_all = ~np.isnan(pos_sv_m_all).any(axis=1) \
+                    & ~np.isnan(corr_pr_m_all).any(axis=1)
+    else:
+        # empty measurements may be missing rows and have no timesteps
+        pos_sv_m_all = np.empty((0,3))
+        corr_pr_m_all = np.empty((0,1))
+        not_nan_all = np.empty(0, dtype=bool)
+
+    if weight_type is not None:
+        if isinstance(weight_type,str) and weight_type in measurements.rows:
+            weights_all = np.atleast_1d(measurements[weight_type]).reshape(-1,1)
+        else:
+            raise TypeError("WLS weights must be None or row"\
+                            +" in NavData")
 
-        corr_pr_m = measurement_subset["corr_pr_m"].reshape(-1,1)
+    if only_bias:
+        rx_times = np.atleast_1d(receiver_state["gps_millis"])
+        pos_rx_m_all = receiver_state[[rx_idxs["x_rx*_m"][0],
+                                       rx_idxs["y_rx*_m"][0],
+                                       rx_idxs["z_rx*_m"][0]]].reshape(3,-1)
 
-        # remove NaN indexes
-        not_nan_indexes = ~np.isnan(pos_sv_m).any(axis=1) & ~np.isnan(corr_pr_m).any(axis=1)
-        pos_sv_m = pos_sv_m[not_nan_indexes]
-        corr_pr_m = corr_pr_m[not_nan_indexes]
+    position = np.zeros((4,1))
+    warm_start = False
+    for timestamp, _, indexes in loop_time_indexes(measurements, "gps_millis",
+                                                   delta_t_decimals):
+
+        indexes = indexes[not_nan_all[indexes]]
+        pos_sv_m = pos_sv_m_all[indexes]
+        corr_pr_m = corr_pr_m_all[indexes]
 
         if weight_type is not None:
-            if isinstance(weight_type,str) and weight_type in measurements.rows:
-                weights = measurement_subset[weight_type].reshape(-1,1)
-                weights = weights[not_nan_indexes]
-            else:
-                raise TypeError("WLS weights must be None or row"\
-                                +" in NavData")
+            weights = weights_all[indexes]
         else:
             weights = None
 
         try:
             if only_bias:
-                position = np.vstack((
-                                  receiver_state.where("gps_millis",
-                                  timestamp)[[rx_idxs["x_rx*_m"][0],
-                                              rx_idxs["y_rx*_m"][0],
-                                              rx_idxs["z_rx*_m"][0]]
-                                              ,0].reshape(-1,1),
-                                             position[3])) # clock bias
-            position = wls(position, pos_sv_m, corr_pr_m, weights,
-                           only_bias, tol, max_count, sv_rx_time=sv_rx_time)
-            states.append([timestamp] + np.squeeze(position).tolist())
+                rx_col = np.flatnonzero(rx_times == timestamp)[0]
+                position = np.vstack((pos_rx_m_all[:,rx_col:rx_col+1],
+                                      position[3])) # clock bias
+            elif len(corr_pr_m) < 4:
+                # fail before the initial guess instead of inside wls
+                raise RuntimeError(_MIN_SVS_ERROR)
+            elif not warm_start:
+                # closed form initial guess until there is a valid fix
+                initial_position = _bancroft(pos_sv_m, corr_pr_m)
+                if np.isfinite(initial_position).all():
+                    position = initial_position
+            state = wls(position, pos_sv_m, corr_pr_m, weights,
+                        only_bias, tol, max_count, sv_rx_time=sv_rx_time)
+            states.append([timestamp] + np.squeeze(state).tolist())
+            # warm start the next timestep from the last valid fix
+            if np.isfinite(state).all():
+                position = state
+                warm_start = True
         except RuntimeError as error:
             if str(error) not in runtime_error_idxs:
                 runtime_error_idxs[str(error)] = [str(int(timestamp))]
@@ -191,7 +230,9 @@ def wls(rx_est_m, pos_sv_m, corr_pr_m, weights = None,
         If True, then only the receiver clock bias is estimated.
         Otherwise, both position and clock bias are estimated.
     tol : float
-        Tolerance used for the convergence check.
+        Tolerance used for the convergence check. Iterations stop once
+        every component of the state update, in meters, is within
+        the tolerance.
     max_count : int
         Number of maximum iterations before process is aborted and
         solution returned.
@@ -228,81 +269,294 @@ def wls(rx_est_m, pos_sv_m, corr_pr_m, weights = None,
     the SV positions need to be updated to reflect the change in the
     frame of reference in which their position is calculated.
 
-    This update happens after every Gauss-Newton update step and is
+    This update happens before every Gauss-Newton update step and is
     adapted from [1]_.
 
+    Each update step is damped as in the Levenberg-Marquardt algorithm.
+    The damping is decreased after steps that reduce the weighted sum
+    of squared residuals and increased after steps that do not, in
+    which case the step is retried from the last accepted estimate.
+
     References
     ----------
     .. [1] https://github.com/google/gps-measurement-tools/blob/master/opensource/FlightTimeCorrection.m
 
     """
 
-    rx_est_m = rx_est_m.copy() # don't change referenced value
+    # convert inputs to contiguous float64 arrays once, which also
+    # copies them so that referenced values don't change
+    rx_est_m = np.array(rx_est_m, dtype=np.float64).reshape(4,1)
+    corr_pr_m = np.ascontiguousarray(corr_pr_m,
+                                     dtype=np.float64).reshape(-1,1)
 
     count = 0
     # Store the SV position at the original receiver time.
     # This position will be modified by the time taken by the signal to
     # travel to the receiver.
-    rx_time_pos_sv_m = pos_sv_m.copy()
+    rx_time_pos_sv_m = np.ascontiguousarray(pos_sv_m, dtype=np.float64)
+    pos_sv_m = rx_time_pos_sv_m.copy()
     num_svs = pos_sv_m.shape[0]
     if num_svs < 4 and not only_bias:
-        raise RuntimeError("Need at least four satellites for WLS.")
-    pos_x_delta = np.inf*np.ones((4,1))
+        raise RuntimeError(_MIN_SVS_ERROR)
 
-    # load weights
+    # load weights as a column instead of a diagonal weight matrix
     if weights is None:
-        weight_matrix = np.eye(num_svs)
+        weights = np.ones((num_svs,1))
     elif isinstance(weights, np.ndarray):
         if weights.ndim != 0 and weights.size == num_svs:
-            weight_matrix = np.eye(num_svs)*weights
+            weights = np.ascontiguousarray(weights,
+                                           dtype=np.float64).reshape(-1,1)
         else:
             raise TypeError("WLS weights must be the same length"\
                             + " as number of satellites.")
     else:
         raise TypeError("WLS weights must be None or np.ndarray.")
 
-    while np.linalg.norm(pos_x_delta) > tol:
-        pos_rx_m = np.tile(rx_est_m[0:3,:].T, (num_svs, 1))
+    # Levenberg-Marquardt damping, only added after a rejected step so
+    # that steps are plain Gauss-Newton until then and again after the
+    # next accepted step. Steps are compared against the larger of the
+    # last two accepted costs, which lets a Gauss-Newton step from a
+    # poor initial guess briefly increase the cost instead of stalling.
+    damping = 0.
+    recent_costs = []
+    accepted_rx_est_m = rx_est_m.copy()
+    rejected = False
+
+    # ranges are only resolved to a few machine epsilon of the ECEF
+    # coordinates, so cost changes below this rounding are not treated
+    # as an increase when accepting steps
+    range_eps = 10.*np.finfo(np.float64).eps \
+              * max(np.max(np.abs(rx_time_pos_sv_m), initial=0.),
+                    np.max(np.abs(corr_pr_m), initial=0.))
+    weight_sum = np.sum(np.abs(weights))
+
+    # flat views of the receiver state for position and clock access
+    # without two dimensional indexing in every iteration
+    rx_state = rx_est_m.reshape(-1)
+    pos_rx_m = rx_state[0:3]
+
+    # preallocate buffers reused in every iteration, the clock bias
+    # column of the geometry matrix is constant
+    los_m = np.empty((num_svs,3))
+    gt_r_m = np.empty((num_svs,1))
+    pr_delta = np.empty((num_svs,1))
+    if only_bias:
+        # the geometry matrix is a column of ones so the normal matrix
+        # is the constant sum of the weights
+        normal_matrix = np.sum(weights).reshape(1,1)
+    else:
+        geometry_matrix = np.ones((num_svs,4))
+        weighted_geometry = np.empty_like(geometry_matrix)
+        normal_matrix = np.empty((4,4))
+        normal_vector = np.empty((4,1))
+
+    # Earth rotation in radians per meter of signal travel and the
+    # parts of the rotation that don't change between iterations
+    rotation_per_m = consts.OMEGA_E_DOT/consts.C
+    pr_rotation = rotation_per_m*corr_pr_m.reshape(-1)
+    x_sv_tx_m = rx_time_pos_sv_m[:,0].copy()
+    y_sv_tx_m = rx_time_pos_sv_m[:,1].copy()
+
+    while True:
+        if not sv_rx_time:
+            # Update the satellite positions based on the time taken for
+            # the signal to reach the Earth and the satellite clock bias.
+            # Done before computing residuals so that the damping step
+            # acceptance always compares costs of rotated positions and
+            # no rotation is computed after the final update.
+            dtheta = pr_rotation - rotation_per_m*rx_state[3]
+            cos_dtheta = np.cos(dtheta)
+            sin_dtheta = np.sin(dtheta)
+            pos_sv_m[:, 0] = cos_dtheta*x_sv_tx_m + sin_dtheta*y_sv_tx_m
+            pos_sv_m[:, 1] = cos_dtheta*y_sv_tx_m - sin_dtheta*x_sv_tx_m
+
+        # receiver to satellite differences shared by the ranges and
+        # the geometry matrix
+        np.subtract(pos_rx_m, pos_sv_m, out=los_m)
+
+        # ranges from the sum of squared differences in a single pass
+        # without a temporary array of squares
+        np.einsum("ij,ij->i", los_m, los_m, out=gt_r_m[:,0])
+        np.sqrt(gt_r_m, out=gt_r_m)
 
-        gt_r_m = np.linalg.norm(pos_rx_m - pos_sv_m, axis = 1,
-                                 keepdims = True)
+        # assumes the use of corrected pseudoranges with the satellite
+        # clock bias already removed
+        np.subtract(corr_pr_m, gt_r_m, out=pr_delta)
+        pr_delta -= rx_state[3]
+        new_cost = (pr_delta.T @ (weights*pr_delta)).item()
+
+        # bias only solves are linear in the clock bias, so every step
+        # is accepted without damping
+        if count > 0 and not only_bias:
+            cost = max(recent_costs)
+            cost_rounding = 2.*np.sqrt(cost*weight_sum)*range_eps \
+                          + weight_sum*range_eps**2
+            rejected = new_cost > cost + cost_rounding \
+                    or not np.isfinite(new_cost)
+        if not rejected:
+            # accept the previous step
+            damping = 0.
+            recent_costs = recent_costs[-1:] + [new_cost]
+            np.copyto(accepted_rx_est_m, rx_est_m)
 
-        if only_bias:
-            geometry_matrix = np.ones((num_svs,1))
+            if only_bias:
+                normal_vector = weights.T @ pr_delta
+            else:
+                np.divide(los_m, gt_r_m, out=geometry_matrix[:,:3])
+
+                # normal equations G^T W G and G^T W r with the weights
+                # applied to the rows of G instead of an N x N matrix
+                np.multiply(geometry_matrix, weights, out=weighted_geometry)
+                np.matmul(weighted_geometry.T, geometry_matrix,
+                          out=normal_matrix)
+                np.matmul(weighted_geometry.T, pr_delta, out=normal_vector)
         else:
-            geometry_matrix = np.ones((num_svs,4))
-            geometry_matrix[:,:3] = np.divide(pos_rx_m - pos_sv_m,
-                                              gt_r_m.reshape(-1,1))
+            # reject the previous step and retry with more damping
+            damping = max(2.*damping, 1e-3)
+
+        if damping > 0.:
+            damped_matrix = normal_matrix \
+                          + damping*np.diag(np.diag(normal_matrix))
+        else:
+            damped_matrix = normal_matrix
 
-        # assumes the use of corrected pseudoranges with the satellite
-        # clock bias already removed
-        pr_delta = corr_pr_m - gt_r_m - rx_est_m[3,0]
         try:
-            pos_x_delta = np.linalg.pinv(geometry_matrix.T @ weight_matrix @ geometry_matrix) \
-                        @ geometry_matrix.T @ weight_matrix @ pr_delta
-        except np.linalg.LinAlgError as exception:
+            pos_x_delta = _solve_normal_equations(damped_matrix,
+                                                  normal_vector)
+        except (np.linalg.LinAlgError, ValueError) as exception:
             print(exception)
             break
 
         if only_bias:
-            rx_est_m[3,0] += pos_x_delta[0,0]
+            np.copyto(rx_est_m, accepted_rx_est_m)
+            rx_state[3] += pos_x_delta.item()
         else:
-            rx_est_m += pos_x_delta
-
-        if not sv_rx_time:
-            # Update the satellite positions based on the time taken for
-            # the signal to reach the Earth and the satellite clock bias.
-            delta_t = (corr_pr_m.reshape(-1) - rx_est_m[3,0])/consts.C
-            dtheta = consts.OMEGA_E_DOT*delta_t
-            pos_sv_m[:, 0] = np.cos(dtheta)*rx_time_pos_sv_m[:,0] + \
-                             np.sin(dtheta)*rx_time_pos_sv_m[:,1]
-            pos_sv_m[:, 1] = -np.sin(dtheta)*rx_time_pos_sv_m[:,0] + \
-                              np.cos(dtheta)*rx_time_pos_sv_m[:,1]
+            np.add(accepted_rx_est_m, pos_x_delta, out=rx_est_m)
 
         count += 1
 
+        # non-finite updates also end the iterations
+        delta_max = np.max(np.abs(pos_x_delta))
+        if delta_max <= tol or not np.isfinite(delta_max):
+            break
+
         if count >= max_count:
             warnings.warn("Newton Raphson did not converge.", RuntimeWarning)
+            if rejected:
+                # the last step was only retried, not evaluated
+                np.copyto(rx_est_m, accepted_rx_est_m)
             break
 
     return rx_est_m
+
+def _bancroft(pos_sv_m, corr_pr_m):
+    """Closed form receiver position and clock bias from pseudoranges.
+
+    Bancroft's method [2]_ solves the unweighted pseudorange equations
+    without iterating or needing an initial guess by solving a
+    quadratic in the Lorentz inner product of the receiver state. It
+    ignores the Earth's rotation during signal travel so it is used as
+    an initial guess for wls.
+
+    Parameters
+    ----------
+    pos_sv_m : np.ndarray
+        Satellite ECEF positions as an array of shape [# svs x 3] where
+        the columns contain in order x_sv_m, y_sv_m, and z_sv_m.
+    corr_pr_m : np.ndarray
+        Corrected pseudoranges for all satellites with shape of
+        [# svs x 1]
+
+    Returns
+    -------
+    rx_est_m : np.ndarray
+        Estimated receiver position in ECEF frame in meters and the
+        estimated receiver clock bias also in meters in an
+        array with shape (4 x 1) and the following order:
+        x_rx_m, y_rx_m, z_rx_m, b_rx_m.
+
+    References
+    ----------
+    .. [2] S. Bancroft, "An Algebraic Solution of the GPS Equations,"
+           IEEE Transactions on Aerospace and Electronic Systems,
+           vol. AES-21, no. 1, pp. 56-59, 1985.
+
+    """
+
+    corr_pr_m = corr_pr_m.reshape(-1)
+    lorentz = np.array([1., 1., 1., -1.])
+
+    # rows of satellite positions and pseudoranges
+    bancroft_matrix = np.column_stack((pos_sv_m, corr_pr_m))
+    alpha = 0.5*np.sum(lorentz*bancroft_matrix**2, axis=1)
+
+    # receiver state is linear in its own Lorentz inner product
+    solution, _, _, _ = np.linalg.lstsq(bancroft_matrix,
+                                        np.column_stack((np.ones_like(alpha),
+                                                         alpha)),
+                                        rcond=None)
+    state_u = lorentz*solution[:,0]
+    state_v = lorentz*solution[:,1]
+
+    quad_a = np.sum(lorentz*state_u*state_u)
+    quad_b = 2.*(np.sum(lorentz*state_u*state_v) - 1.)
+    quad_c = np.sum(lorentz*state_v*state_v)
+    discriminant = np.sqrt(max(quad_b**2 - 4.*quad_a*quad_c, 0.))
+
+    # keep the root that best fits the pseudoranges
+    rx_est_m = np.full((4,1), np.nan)
+    best_residual = np.inf
+    for sign in (-1., 1.):
+        lorentz_product = (-quad_b + sign*discriminant)/(2.*quad_a)
+        state = lorentz_product*state_u + state_v
+        residual = np.sum(np.abs(corr_pr_m - state[3] \
+                 - np.linalg.norm(pos_sv_m - state[:3], axis=1)))
+        if residual < best_residual:
+            best_residual = residual
+            rx_est_m = state.reshape(-1,1)
+
+    return rx_est_m
+
+def _solve_normal_equations(normal_matrix, normal_vector):
+    """Solves the normal equations of the least squares update.
+
+    The normal matrix is symmetric positive semi-definite so it is
+    solved with a Cholesky factorization instead of a pseudo-inverse.
+    The factorization and triangular solves are a single call to
+    LAPACK's ``dposv`` to avoid wrapper overhead on these small
+    matrices. If the factorization fails because the geometry is rank
+    deficient, the minimum norm least squares solution is found with
+    LAPACK's ``gelsy`` driver, which matches the pseudo-inverse
+    solution without forming the pseudo-inverse.
+
+    Parameters
+    ----------
+    normal_matrix : np.ndarray
+        Normal matrix of shape [# states x # states], i.e. the
+        weighted geometry matrix product G^T W G.
+    normal_vector : np.ndarray
+        Normal vector of shape [# states x 1], i.e. G^T W r where r
+        are the pseudorange residuals.
+
+    Returns
+    -------
+    state_delta : np.ndarray
+        Least squares state update of shape [# states x 1].
+
+    """
+
+    if not np.isfinite(normal_matrix).all():
+        raise ValueError("WLS normal matrix has non-finite values.")
+
+    # a single state, as when only solving for the clock bias, needs
+    # no factorization
+    if normal_matrix.shape == (1,1) and normal_matrix[0,0] > 0.:
+        return normal_vector / normal_matrix
+
+    _, state_delta, info = _DPOSV(normal_matrix, normal_vector, lower=1)
+    if info != 0:
+        state_delta, _, _, _ = lstsq(normal_matrix, normal_vector,
+                                     check_finite=False,
+                                     lapack_driver="gelsy")
+
+    return state_delta
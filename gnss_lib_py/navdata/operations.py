@@ -194,6 +194,58 @@ def loop_time(navdata, time_row, delta_t_decimals=2):
             frame_time = time
         yield frame_time, delta_t, new_navdata
 
+def loop_time_indexes(navdata, time_row, delta_t_decimals=2):
+    """Generator object to loop over column indexes from same times.
+
+    Groups columns the same way as :func:`loop_time` but yields column
+    indexes into the original NavData instead of new NavData
+    instances, so each timestep only costs two binary searches into
+    the sorted times.
+
+    Parameters
+    ----------
+    navdata : gnss_lib_py.navdata.navdata.NavData
+        Navdata instance.
+    time_row : string/int
+        Key or index of the row in which times are stored.
+    delta_t_decimals : int
+        Decimal places after which times are considered equal.
+
+    Yields
+    ------
+    timestamp : float
+        Current timestamp.
+    delta_t : float
+        Difference between current time and previous time.
+    indexes : np.ndarray
+        Sorted column indexes of the columns with same time, up to
+        given decimal tolerance.
+
+    """
+
+    times = np.atleast_1d(navdata[time_row]).astype(np.float64)
+    order = np.argsort(times, kind="stable")
+    sorted_times = times[order]
+    times_unique = np.unique(np.around(times, decimals=delta_t_decimals))
+    starts = np.searchsorted(sorted_times,
+                             times_unique - 10**(-delta_t_decimals),
+                             side="left")
+    stops = np.searchsorted(sorted_times,
+                            times_unique + 10**(-delta_t_decimals),
+                            side="right")
+    for time_idx, time in enumerate(times_unique):
+        if time_idx==0:
+            delta_t = 0
+        else:
+            delta_t = time-times_unique[time_idx-1]
+        indexes = np.sort(order[starts[time_idx]:stops[time_idx]])
+        frame_times = np.unique(times[indexes])
+        if len(frame_times)==1:
+            frame_time = frame_times[0]
+        else:
+            frame_time = time
+        yield frame_time, delta_t, indexes
+
 def interpolate(navdata, x_row, y_rows, inplace=False, *args):
     """Interpolate NaN values based on row data.
 
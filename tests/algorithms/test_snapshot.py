@@ -13,7 +13,9 @@ import numpy as np
 
 from gnss_lib_py.parsers.google_decimeter import AndroidDerived2021, AndroidDerived2022
 from gnss_lib_py.navdata.navdata import NavData
-from gnss_lib_py.algorithms.snapshot import wls, solve_wls
+from gnss_lib_py.algorithms.snapshot import wls, solve_wls, \
+                                            _solve_normal_equations, \
+                                            _bancroft
 from gnss_lib_py.navdata.operations import loop_time
 
 # Defining test fixtures
@@ -107,11 +109,54 @@ def test_wls(set_user_states, set_sv_states, tolerance):
     np.testing.assert_array_almost_equal(user_fix, truth_fix,
                                          decimal=tolerance)
 
+    # starting at the solution or far away should give the same fix
+    # when accounting for the Earth's rotation
+    user_fix = wls(rx_est_m, pos_sv_m, gt_pr_m, sv_rx_time=False)
+    warm_fix = wls(user_fix, pos_sv_m, gt_pr_m, sv_rx_time=False)
+    truth_start_fix = wls(rx_truth_m, pos_sv_m, gt_pr_m, sv_rx_time=False)
+    np.testing.assert_array_almost_equal(warm_fix, user_fix,
+                                         decimal=tolerance)
+    np.testing.assert_array_almost_equal(truth_start_fix, user_fix,
+                                         decimal=tolerance)
+
+    # inputs should not be modified when rotating satellite positions
+    pos_sv_m_input = pos_sv_m.copy()
+    wls(rx_est_m, pos_sv_m, gt_pr_m, sv_rx_time=False)
+    np.testing.assert_array_equal(pos_sv_m, pos_sv_m_input)
+    np.testing.assert_array_equal(rx_est_m, np.zeros((4,1)))
+
     # should return warning if only three satellites are given
     with pytest.raises(RuntimeError) as excinfo:
         wls(rx_est_m, pos_sv_m[:3,:], gt_pr_m[:3,:])
     assert "Need at least four satellites" in str(excinfo.value)
 
+def test_bancroft(set_user_states, set_sv_states):
+    """Test closed form positioning against truth user states.
+
+    Parameters
+    ----------
+    set_user_states : fixture
+        Truth values for user position and clock bias
+    set_sv_states : fixture
+        Satellite position and clock biases
+    """
+    rx_truth_m  = set_user_states
+    pos_sv_m = set_sv_states
+
+    # Compute noise-free pseudorange measurements
+    gt_pr_m = np.linalg.norm(rx_truth_m[0:3,:].T - pos_sv_m, axis = 1,
+                             keepdims = True) + rx_truth_m[3,0]
+
+    rx_est_m = _bancroft(pos_sv_m, gt_pr_m)
+    assert rx_est_m.shape == (4,1)
+    np.testing.assert_array_almost_equal(rx_est_m, rx_truth_m,
+                                         decimal=4)
+
+    # should be a good initial guess for wls with rotation of the Earth
+    user_fix = wls(np.zeros((4,1)), pos_sv_m, gt_pr_m, sv_rx_time=False)
+    bancroft_fix = wls(rx_est_m, pos_sv_m, gt_pr_m, sv_rx_time=False)
+    np.testing.assert_array_almost_equal(bancroft_fix, user_fix)
+
 @pytest.mark.parametrize('random_noise',
                          np.random.normal(0,20,size=(TEST_REPEAT_COUNT,4,1))
                         )
@@ -454,6 +499,72 @@ def test_solve_wls_bias_only(derived_2022):
     with pytest.raises(RuntimeError):
         solve_wls(derived_2022, only_bias=True, sv_rx_time=False)
 
+def test_solve_wls_warm_start(derived_2022):
+    """Tests that invalid fixes don't warm start later timesteps.
+
+    Parameters
+    ----------
+    derived_2022 : AndroidDerived2022
+        Instance of AndroidDerived2022 for testing
+    """
+
+    receiver_state = derived_2022.copy()
+    first_time = np.min(receiver_state["gps_millis"])
+    first_cols = receiver_state.argwhere("gps_millis", first_time)
+    receiver_state["x_rx_m", first_cols] = np.nan
+
+    state_estimate = solve_wls(derived_2022, only_bias=True,
+                               receiver_state=receiver_state,
+                               sv_rx_time=False)
+
+    # only the timestep without a receiver position should be invalid
+    assert np.isnan(state_estimate["b_rx_wls_m",0])
+    assert np.isfinite(state_estimate["b_rx_wls_m",1:]).all()
+
+def test_solve_wls_converges(derived_2021, derived_2022):
+    """Tests that every timestep converges within three iterations.
+
+    The undamped solver needed up to four iterations per timestep on
+    these logs, so damping must not add iterations.
+
+    Parameters
+    ----------
+    derived_2021 : AndroidDerived2021
+        Instance of AndroidDerived2021 for testing
+    derived_2022 : AndroidDerived2022
+        Instance of AndroidDerived2022 for testing
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        solve_wls(derived_2021, max_count=3)
+        solve_wls(derived_2022, max_count=3)
+        solve_wls(derived_2022, max_count=3, sv_rx_time=True)
+        solve_wls(derived_2022, only_bias=True, receiver_state=derived_2022,
+                  max_count=3)
+
+def test_wls_four_satellites_from_zero():
+    """Tests an exactly determined fix from a zero initial state.
+
+    The first Gauss-Newton step from the center of the Earth increases
+    the cost for this geometry, which must not stall the damping.
+
+    """
+
+    pos_sv_m = np.array([[ 23734204.,  10864502.,   4907522.],
+                         [ 14458521.,  13836815., -17462168.],
+                         [ 11560570.,  -5171081., -23346236.],
+                         [ 11767675.,   3718537., -23518672.]])
+    rx_truth_m = np.array([[4942038.], [-2057259.], [-3454503.], [91771.]])
+    corr_pr_m = np.linalg.norm(pos_sv_m - rx_truth_m[:3,0], axis=1,
+                               keepdims=True) + rx_truth_m[3]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        rx_est_m = wls(np.zeros((4,1)), pos_sv_m, corr_pr_m,
+                       sv_rx_time=True)
+
+    np.testing.assert_array_almost_equal(rx_est_m, rx_truth_m, decimal=5)
 
 def test_wls_fails(capsys):
     """Test expected fails
@@ -471,7 +582,45 @@ def test_wls_fails(capsys):
 
     wls(np.ones((4,1)),pos_sv_m,np.ones((5,1)))
     captured = capsys.readouterr()
-    assert captured.out == "SVD did not converge\n"
+    assert captured.out == "WLS normal matrix has non-finite values.\n"
+
+def test_solve_normal_equations(set_sv_states):
+    """Test the Cholesky solve of the WLS normal equations.
+
+    Parameters
+    ----------
+    set_sv_states : fixture
+        Satellite position and clock biases
+
+    """
+    pos_sv_m = set_sv_states
+    geometry_matrix = np.ones((pos_sv_m.shape[0],4))
+    geometry_matrix[:,:3] = pos_sv_m / np.linalg.norm(pos_sv_m, axis=1,
+                                                      keepdims=True)
+    residuals = np.arange(pos_sv_m.shape[0]).reshape(-1,1)
+
+    # full rank geometry should match the pseudo-inverse solution
+    state_delta = _solve_normal_equations(geometry_matrix.T @ geometry_matrix,
+                                          geometry_matrix.T @ residuals)
+    np.testing.assert_array_almost_equal(state_delta,
+                                         np.linalg.pinv(geometry_matrix) \
+                                         @ residuals)
+
+    # a single state should match the pseudo-inverse solution
+    geometry_matrix = np.ones((pos_sv_m.shape[0],1))
+    state_delta = _solve_normal_equations(geometry_matrix.T @ geometry_matrix,
+                                          geometry_matrix.T @ residuals)
+    np.testing.assert_array_almost_equal(state_delta,
+                                         np.linalg.pinv(geometry_matrix) \
+                                         @ residuals)
+
+    # rank deficient geometry should match the minimum norm solution
+    geometry_matrix = np.ones((pos_sv_m.shape[0],4))
+    state_delta = _solve_normal_equations(geometry_matrix.T @ geometry_matrix,
+                                          geometry_matrix.T @ residuals)
+    np.testing.assert_array_almost_equal(state_delta,
+                                         np.linalg.pinv(geometry_matrix) \
+                                         @ residuals)
 
 def test_solve_wls_fails(derived_2021):
     """Test expected fails
@@ -295,6 +295,33 @@ def test_time_looping(csv_simple):
         np.testing.assert_almost_equal(time, expected_times[count])
         count += 1
 
+@pytest.mark.parametrize('delta_t_decimals',
+                         [-3, -2, 0])
+def test_time_looping_indexes(derived_2021, delta_t_decimals):
+    """Test time grouping indexes match the loop_time generator.
+
+    Parameters
+    ----------
+    derived_2021 : AndroidDerived2021
+        Instance of AndroidDerived2021 for testing.
+    delta_t_decimals : int
+        Decimal places after which times are considered equal.
+
+    """
+    expected = list(op.loop_time(derived_2021, "gps_millis",
+                                 delta_t_decimals=delta_t_decimals))
+    groups = list(op.loop_time_indexes(derived_2021, "gps_millis",
+                                       delta_t_decimals=delta_t_decimals))
+
+    assert len(groups) == len(expected)
+    for (time, delta_t, indexes), (exp_time, exp_delta_t, exp_navdata) \
+        in zip(groups, expected):
+        assert time == exp_time
+        assert delta_t == exp_delta_t
+        for row in ["gps_millis", "x_sv_m", "corr_pr_m"]:
+            np.testing.assert_array_equal(derived_2021[row][indexes],
+                                          np.atleast_1d(exp_navdata[row]))
+
 def test_sort(data, df_simple):
     """Test sorting function across simple dataframe.
 